@@ -1,8 +1,20 @@
-from netCDF4 import Dataset, numpy
 import numpy as np
+import errno
+import io
 import os
+import shutil
+import struct
+import tempfile
 from glob import glob
 from contextlib import contextmanager
+from collections import OrderedDict
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 
 def flatten(lst):
@@ -15,21 +27,49 @@ def flatten(lst):
     return result
 
 
+def dataset(*args, **kwargs):
+    # netCDF4 (and the HDF5 library) is loaded on the first data access.
+    from netCDF4 import Dataset
+    return Dataset(*args, **kwargs)
+
+
 DTYPES = {}
-DTYPES[numpy.dtype('float32')] = 'f4'
-DTYPES[numpy.dtype('int32')] = 'i4'
-DTYPES[numpy.dtype('int8')] = 'i1'
-DTYPES[numpy.dtype('S1')] = 'S1'
+DTYPES[np.dtype('float32')] = 'f4'
+DTYPES[np.dtype('int32')] = 'i4'
+DTYPES[np.dtype('int8')] = 'i1'
+DTYPES[np.dtype('S1')] = 'S1'
+
+# the netCDF library is not thread safe, so its calls are serialized.
+LIBRARY_LOCK = threading.RLock()
+PREFETCH_DEPTH = 2
+PREFETCH_MEMORY = 256 * 1024 ** 2
+VARIABLES_CACHE_SIZE = 64
+PLANNER_MEMORY = 64 * 1024 ** 2
+PLANNER_OVERREAD = 8
+EXPRESSION_MEMORY = 64 * 1024 ** 2
+TRANSACTION_WORKERS = 4
+JOURNAL = '.netcdf.%i.journal'
 
 
 class NCObject(object):
 
     @classmethod
-    def open(cls, files_or_pattern):
+    def open(cls, files_or_pattern, overlay=False, transaction=False,
+             checksum=False):
         files, pattern = cls.distill(files_or_pattern)
+        if transaction:
+            recover(files)
         obj = cls.choice_type(files)
         obj.pattern = pattern
-        obj.load()
+        obj.overlay = overlay
+        obj.transaction = transaction
+        obj.checksum = checksum
+        try:
+            obj.load()
+        except Exception:
+            # remove the temporary copies staged before the failure.
+            obj.rollback()
+            raise
         return obj
 
     @classmethod
@@ -56,12 +96,22 @@ class NCObject(object):
         super(NCObject, self).__init__()
         self.files = files
         self.files.sort()
-        self.variables = {}
+        self.variables = OrderedDict()
         self._is_new = [not os.path.exists(f) for f in self.files]
         self.roots = []
         self.variable_wrapper = lambda name, vars: name, vars
         self.create_dim = 'create_dimension'
         self._read_only = True
+        self.windows = {}
+        self.registry = None
+        self.prefetcher = None
+        self.planner = None
+        self.overlay = False
+        self.delta = {}
+        self.transaction = False
+        self.checksum = False
+        self.temporary = None
+        self.modified = False
 
     @property
     def is_new(self):
@@ -69,24 +119,33 @@ class NCObject(object):
 
     @property
     def dimensions(self):
-        dicts = [r.dimensions for r in self.roots]
-        keys = {k for d in dicts for k in d}
-        return {k: flatten([d.get(k) for d in dicts])
-                for k in keys}
+        # registry of the dimensions of each file, built on the first access.
+        if self.registry is None:
+            self.registry = {}
+            for dimensions in [r.dimensions for r in self.roots]:
+                for name, dimension in dimensions.items():
+                    (self.registry.setdefault(name, [])
+                     .extend(flatten([dimension])))
+        return self.registry
 
     def has_dimension(self, name):
-        return all([name in r.dimensions.keys() for r in self.roots])
+        return len(self.dimensions.get(name, [])) == len(self.roots)
 
     def create_dimension(self, name, size):
-        return [getattr(r, self.create_dim)(name, size) for r in self.roots]
+        self.modified = True
+        created = [getattr(r, self.create_dim)(name, size)
+                   for r in self.roots]
+        self.dimensions[name] = flatten(created)
+        return created
 
     def obtain_dimension(self, name):
         return self.dimensions[name]
 
     def getdim(self, name, size=None):
-        return (self.obtain_dimension(name)
-                if self.has_dimension(name)
-                else self.create_dimension(name, size))
+        with LIBRARY_LOCK:
+            return (self.obtain_dimension(name)
+                    if self.has_dimension(name)
+                    else self.create_dimension(name, size))
 
     def obtain_variable(self, *args, **kwargs):
         raise Exception('Subclass responsability (should process %s and %s)' %
@@ -94,19 +153,87 @@ class NCObject(object):
 
     def getvar(self, name, vtype='', dimensions=(), digits=0,
                fill_value=None, source=None):
-        if source:
-            self.copy_in(name, vtype, source)
-        if name not in self.variables.keys():
-            varstmp = self.obtain_variable(name, vtype, dimensions,
-                                           digits, fill_value)
-            self.variables[name] = self.variable_wrapper(name, varstmp)
-        return self.variables[name]
+        with LIBRARY_LOCK:
+            if source:
+                self.copy_in(name, vtype, source)
+            if name not in self.variables:
+                varstmp = self.obtain_variable(name, vtype, dimensions,
+                                               digits, fill_value)
+                self.variables[name] = self.variable_wrapper(name, varstmp,
+                                                             self)
+                # evict the least recently used variables.
+                while len(self.variables) > VARIABLES_CACHE_SIZE:
+                    self.variables.popitem(last=False)
+            else:
+                self.variables[name] = self.variables.pop(name)
+            return self.variables[name]
+
+    def subset(self, bbox):
+        key = tuple(bbox)
+        if key not in self.windows:
+            with LIBRARY_LOCK:
+                self.windows[key] = self.obtain_window(*key)
+        return NCSubset(self, self.windows[key])
+
+    def export(self, out_pattern, group_by=None, variables=None, storage=None,
+               workers=1, progress=None):
+        self.sync()
+        groups = OrderedDict()
+        with LIBRARY_LOCK:
+            steps = self.steps()
+        for filename, source, step in steps:
+            key = group_by(filename, step) if group_by else None
+            groups.setdefault(key, []).append((source, step))
+        options = {'zlib': True}
+        options.update(storage if storage else {})
+        deltas = self.deltas()
+        tasks = [(out_pattern % key if group_by else out_pattern, units,
+                  variables, options,
+                  {f: deltas[f] for f, _ in units if f in deltas})
+                 for key, units in groups.items()]
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        outputs = []
+        written = (pool.imap_unordered(export_group, tasks)
+                   if pool else (serialized(export_group, t) for t in tasks))
+        try:
+            for output in written:
+                outputs.append(output)
+                if progress:
+                    progress(len(outputs), len(tasks))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        return sorted(outputs)
 
     def sync(self):
-        return [r.sync() for r in self.roots]
+        with LIBRARY_LOCK:
+            return [r.sync() for r in self.roots]
+
+    def release(self):
+        with LIBRARY_LOCK:
+            return [r.close() for r in self.roots]
 
     def close(self):
-        return [r.close() for r in self.roots]
+        # commit the temporary copies of the modified files of a
+        # transaction, or discard all of them if any checksum fails.
+        staged = self.staged()
+        closed = self.release()
+        changed = [r for r in staged if r.modified or r.is_new]
+        try:
+            list(map(verify, [r.temporary for r in changed if r.checksum]))
+        except Exception:
+            list(map(NCFile.discard, staged))
+            raise
+        list(map(NCFile.discard, [r for r in staged if r not in changed]))
+        commit(changed)
+        return closed
+
+    def rollback(self):
+        staged = self.staged()
+        closed = self.release()
+        list(map(NCFile.discard, staged))
+        return closed
 
     def copy_in(self, name, vtype, source):
         # create dimensions if not exists.
@@ -126,17 +253,48 @@ class NCObject(object):
 
 class NCFile(NCObject):
 
-    def load(self):
+    def stage(self):
         filename = self.files[0]
-        try:
-            self.roots = [(Dataset(filename, mode='w', format='NETCDF4')
-                           if self.is_new else Dataset(filename, mode='a',
-                                                       format='NETCDF4'))]
-            self._read_only = False
-        except Exception:
-            self.roots = [Dataset(filename, mode='r', format='NETCDF4')]
+        if self.is_new or os.access(filename, os.W_OK):
+            directory, name = os.path.split(os.path.abspath(filename))
+            # the process id identifies the copies left by a crash.
+            handler, self.temporary = tempfile.mkstemp(
+                prefix='.%s.%i.' % (name, os.getpid()), suffix='.tmp',
+                dir=directory)
+            os.close(handler)
+            if not self.is_new:
+                shutil.copy2(filename, self.temporary)
+
+    def replace(self):
+        os.rename(self.temporary, self.files[0])
+        self.temporary = None
+
+    def discard(self):
+        os.remove(self.temporary)
+        self.temporary = None
+
+    def staged(self):
+        return [self] if self.temporary else []
+
+    @property
+    def source(self):
+        return self.temporary if self.temporary else self.files[0]
+
+    def load(self):
+        if self.transaction and not self.temporary:
+            self.stage()
+        filename = self.source
+        with LIBRARY_LOCK:
+            try:
+                self.roots = [(dataset(filename, mode='w', format='NETCDF4')
+                               if self.is_new else
+                               dataset(filename, mode='a', format='NETCDF4'))]
+                self._read_only = False
+            except Exception:
+                self.roots = [dataset(filename, mode='r', format='NETCDF4')]
         self.variable_wrapper = SingleNCVariable
         self.create_dim = 'createDimension'
+        self.planner = Planner(PLANNER_MEMORY)
 
     @property
     def read_only(self):
@@ -151,8 +309,10 @@ class NCFile(NCObject):
 
     def create_variable(self, name, vtype='f4', dimensions=(), digits=0,
                         fill_value=None):
+        self.modified = True
         build = self.roots[0].createVariable
         options = {'zlib': True,
+                   'fletcher32': self.checksum,
                    'fill_value': fill_value}
         if digits > 0:
             options['least_significant_digit'] = digits
@@ -161,32 +321,162 @@ class NCFile(NCObject):
         list(map(not_auto_mask, varstmp))
         return varstmp
 
+    def steps(self):
+        root = self.roots[0]
+        unlimited = [d for d in root.dimensions.values() if d.isunlimited()]
+        count = len(unlimited[0]) if unlimited else 1
+        return [(self.files[0], self.source, step)
+                for step in range(max(count, 1))]
+
+    def deltas(self):
+        return {self.source: self.delta} if self.delta else {}
+
+    def obtain_window(self, lat_min, lat_max, lon_min, lon_max):
+        root = self.roots[0]
+        lat, lon = root.variables['lat'], root.variables['lon']
+        lat_values, lon_values = np.asarray(lat[:]), np.asarray(lon[:])
+        inside = ((lat_values >= lat_min) & (lat_values <= lat_max) &
+                  (lon_values >= lon_min) & (lon_values <= lon_max))
+        while inside.ndim > 2:
+            inside = inside.any(axis=0)
+        rows = np.where(inside.any(axis=1))[0]
+        cols = np.where(inside.any(axis=0))[0]
+        if not len(rows):
+            raise Exception('The bounding box is outside of the grid.')
+        y_dim, x_dim = lat.dimensions[-2:]
+        return {y_dim: slice(rows[0], rows[-1] + 1),
+                x_dim: slice(cols[0], cols[-1] + 1)}
+
 
 class NCPackage(NCObject):
 
     def load(self):
-        self.roots = [NCObject.open(filename) for filename in self.files]
+        self.roots = [NCFile([filename]) for filename in self.files]
+        for r in self.roots:
+            r.pattern, r.overlay = r.files[0], self.overlay
+            r.transaction, r.checksum = self.transaction, self.checksum
+        if self.transaction:
+            pool = ThreadPool(TRANSACTION_WORKERS)
+            try:
+                pool.map(NCFile.stage, self.roots)
+            finally:
+                pool.close()
+                pool.join()
+        list(map(NCFile.load, self.roots))
         self.variable_wrapper = DistributedNCVariable
+        self.prefetcher = Prefetcher(PREFETCH_DEPTH, PREFETCH_MEMORY)
+        # the files share the planner to align the reads of all the package.
+        self.planner = Planner(PLANNER_MEMORY)
+        for r in self.roots:
+            r.planner = self.planner
 
     @property
     def read_only(self):
         return all([r.read_only for r in self.roots])
 
+    def release(self):
+        # the prefetcher is closed out of the lock, to let it finish.
+        if self.prefetcher:
+            self.prefetcher.close()
+        return [r.release() for r in self.roots]
+
+    def staged(self):
+        return [r for r in self.roots if r.temporary]
+
     def obtain_variable(self, name, vtype='f4', dimensions=(), digits=0,
                         fill_value=None):
-        return [r.getvar(name, vtype, dimensions, digits, fill_value)
-                for r in self.roots]
+        # keep only the netCDF handle of each file, without wrappers.
+        handles = [r.obtain_variable(name, vtype, dimensions, digits,
+                                     fill_value) for r in self.roots]
+        return [h[0] if h.__class__ is list else h for h in handles]
+
+    def steps(self):
+        return [step for r in self.roots for step in r.steps()]
 
+    def deltas(self):
+        deltas = {}
+        list(map(deltas.update, [r.deltas() for r in self.roots]))
+        return deltas
 
-class NCVariable(object):
+    def obtain_window(self, *bbox):
+        # all the files of a package share the same lat/lon grid.
+        return self.roots[0].obtain_window(*bbox)
 
-    def __init__(self, name, variables):
+
+class NCSubset(object):
+
+    def __init__(self, root, window):
+        super(NCSubset, self).__init__()
+        self.root = root
+        self.window = window
+
+    def getvar(self, name, *args, **kwargs):
+        return self.root.getvar(name, *args, **kwargs).windowed(self.window)
+
+
+def arithmetic(function, reflected=False):
+    def build(self, other):
+        return Expression(function,
+                          (other, self) if reflected else (self, other))
+    return build
+
+
+def materialize(operand):
+    return (operand[:] if isinstance(operand, NCVariable) else
+            operand.compute() if isinstance(operand, Expression) else operand)
+
+
+COMPARISONS = [np.equal, np.not_equal, np.less, np.less_equal, np.greater,
+               np.greater_equal]
+
+
+class Operators(object):
+
+    __slots__ = ()
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs:
+            return NotImplemented
+        if ufunc in COMPARISONS:
+            # the comparisons are evaluated, as with the numpy arrays.
+            return ufunc(*[materialize(i) for i in inputs])
+        return Expression(ufunc, inputs)
+
+    __add__ = arithmetic(np.add)
+    __radd__ = arithmetic(np.add, True)
+    __sub__ = arithmetic(np.subtract)
+    __rsub__ = arithmetic(np.subtract, True)
+    __mul__ = arithmetic(np.multiply)
+    __rmul__ = arithmetic(np.multiply, True)
+    __div__ = arithmetic(np.divide)
+    __rdiv__ = arithmetic(np.divide, True)
+    __truediv__ = arithmetic(np.true_divide)
+    __rtruediv__ = arithmetic(np.true_divide, True)
+    __pow__ = arithmetic(np.power)
+    __rpow__ = arithmetic(np.power, True)
+
+    def __neg__(self):
+        return Expression(np.negative, (self,))
+
+    def __abs__(self):
+        return Expression(np.absolute, (self,))
+
+
+class NCVariable(Operators):
+
+    __slots__ = ('name', 'variables', 'root', 'window')
+
+    def __init__(self, name, variables, root=None, window=None):
         self.name = name
-        self.variables = (variables
-                          if variables.__class__ is list else [variables])
+        self.variables = tuple(variables
+                               if variables.__class__ in [list, tuple]
+                               else [variables])
+        self.root = root
+        self.window = window if window else {}
 
     def __eq__(self, obj):
-        return (self.pack() == obj[:]).all()
+        with LIBRARY_LOCK:
+            return (self.pack() == obj[:]).all()
 
     @property
     def shape(self):
@@ -222,47 +512,792 @@ class NCVariable(object):
         ipdb.set_trace()
 
     def sync(self):
-        for variable in self.variables:
-            variable.group().sync()
+        with LIBRARY_LOCK:
+            for variable in self.variables:
+                variable.group().sync()
 
 
 class SingleNCVariable(NCVariable):
 
+    __slots__ = ()
+
     def group(self):
         return self.variables[0].group()
 
-    def pack(self):
-        varstmp = self.variables[0]
-        if self.variables[0].shape[0] > 1:
-            varstmp = np.vstack([self.variables])
+    def hyperslab(self):
+        return tuple(self.window.get(d, slice(None))
+                     for d in self.variables[0].dimensions)
+
+    def windowed(self, window):
+        return SingleNCVariable(self.name, self.variables, self.root, window)
+
+    def block_shape(self, index=0):
+        handle = self.variables[0]
+        shape = tuple(len(range(*s.indices(size)))
+                      for s, size in zip(self.hyperslab(), handle.shape))
+        return shape if handle.shape[0] > 1 else shape[1:]
+
+    def unpacked(self, indexes):
+        # the pack of a file with many steps has a leading axis of size one.
+        indexes = indexes if indexes.__class__ is tuple else (indexes,)
+        basic = all(isinstance(i, (int, np.integer, slice)) and
+                    not isinstance(i, bool) for i in indexes)
+        if basic and isinstance(indexes[0], (int, np.integer)) and (
+                indexes[0] in [0, -1]):
+            return indexes[1:] if len(indexes) > 1 else slice(None)
+
+    def read(self, indexes):
+        planner = self.root.planner if self.root else None
+        return (planner.read(self.variables[0], indexes) if planner
+                else self.variables[0][indexes])
+
+    @property
+    def delta(self):
+        # blocks written over a read only root when the overlay is enabled.
+        root = self.root
+        return (root.delta.setdefault(self.name, {})
+                if root and root.overlay and root.read_only else None)
+
+    def blocks(self, slab):
+        return np.arange(self.variables[0].shape[0])[slab[0]]
+
+    def merge(self, varstmp, delta):
+        if not delta:
+            return varstmp
+        slab = self.hyperslab()
+        varstmp = np.array(varstmp)
+        for position, block in enumerate(self.blocks(slab)):
+            if block in delta:
+                varstmp[position] = delta[block][slab[1:]]
         return varstmp
 
+    def overlap(self, varstmp, delta):
+        slab = self.hyperslab()
+        for position, block in enumerate(self.blocks(slab)):
+            current = (delta[block] if block in delta
+                       else np.array(self.variables[0][block]))
+            changed = np.array(current)
+            changed[slab[1:]] = varstmp[position]
+            if not np.array_equal(changed, current):
+                delta[block] = changed
+
+    def pack(self):
+        with LIBRARY_LOCK:
+            varstmp = self.variables[0]
+            delta = self.delta
+            if self.window or delta:
+                varstmp = self.merge(self.read(self.hyperslab()), delta)
+                if self.variables[0].shape[0] > 1:
+                    varstmp = varstmp[np.newaxis]
+            elif self.variables[0].shape[0] > 1:
+                varstmp = np.vstack([self.variables])
+            return varstmp
+
+    def __getitem__(self, indexes):
+        with LIBRARY_LOCK:
+            steps = self.variables[0].shape[0] > 1
+            rest = (self.unpacked(indexes)
+                    if steps and not (self.window or self.delta) else None)
+            if rest is not None:
+                return np.asarray(self.read(rest))
+            if self.window or self.delta or steps:
+                return NCVariable.__getitem__(self, indexes)
+            return self.read(indexes)
+
+    def store(self, index, values, rows=None):
+        # the block of a file with one step lacks the first axis.
+        steps = self.variables[0].shape[0] > 1
+        if rows is None:
+            self[:] = values if steps else values[np.newaxis]
+        else:
+            self[(rows,) if steps else (0, rows)] = values
+
     def __setitem__(self, indexes, changes):
-        return self.variables[0].__setitem__(indexes, changes)
+        with LIBRARY_LOCK:
+            self.write(indexes, changes)
+
+    def write(self, indexes, changes):
+        delta = self.delta
+        if self.root and delta is None:
+            self.root.modified = True
+        if self.root and self.root.planner and delta is None:
+            self.root.planner.invalidate(self.variables[0])
+        if not self.window and delta is None:
+            return self.variables[0].__setitem__(indexes, changes)
+        slab = self.hyperslab()
+        varstmp = self.merge(self.read(slab), delta)
+        varstmp.__setitem__(indexes, changes)
+        if delta is None:
+            self.variables[0][slab] = varstmp
+        else:
+            self.overlap(varstmp, delta)
 
 
 class DistributedNCVariable(NCVariable):
 
+    __slots__ = ()
+
+    def windowed(self, window):
+        return DistributedNCVariable(self.name, self.variables, self.root,
+                                     window)
+
+    def part(self, index):
+        # wrap the handle of a file only while it is used.
+        return SingleNCVariable(self.name, self.variables[index],
+                                self.root.roots[index], self.window)
+
+    def block_shape(self, index):
+        return self.part(index).block_shape()
+
     def pack(self):
-        return np.vstack([variable.pack() for variable in self.variables])
+        with LIBRARY_LOCK:
+            return np.vstack([self.part(i).pack()
+                              for i in range(len(self.variables))])
+
+    def split(self, indexes):
+        # return the selected files and the hyperslab read from each one.
+        indexes = indexes if indexes.__class__ is tuple else (indexes,)
+        index, handle = indexes[0], self.variables[0]
+        basic = all(isinstance(i, (int, np.integer, slice)) and
+                    not isinstance(i, bool) for i in indexes)
+        if not basic or (handle.ndim < 2 and handle.shape[0] <= 1):
+            return None, indexes
+        if isinstance(index, slice):
+            files = list(range(len(self.variables)))[index]
+            return (files if files else None), indexes[1:]
+        index = index + len(self.variables) if index < 0 else index
+        return ((index, indexes[1:]) if 0 <= index < len(self.variables)
+                else (None, indexes))
+
+    def fetch(self, index, rest):
+        with LIBRARY_LOCK:
+            return np.asarray(self.part(index)[(0,) + rest])
 
-    def __setitem__(self, indexes, change):
-        pack = self.pack()
-        pack.__setitem__(indexes, change)
-        varstmp = np.vsplit(pack, pack.shape[0])
-        for i in range(len(varstmp)):
-            self.variables[i][:] = varstmp[i]
-        self.sync()
+    def __getitem__(self, indexes):
+        index, rest = self.split(indexes)
+        prefetcher = self.root.prefetcher if self.root else None
+        if index is None:
+            with LIBRARY_LOCK:
+                return NCVariable.__getitem__(self, indexes)
+        if index.__class__ is list:
+            with LIBRARY_LOCK:
+                return np.concatenate([
+                    np.asarray(self.part(i)[(slice(0, 1),) + rest])
+                    for i in index])
+        return (prefetcher.read(self, index, rest) if prefetcher
+                else self.fetch(index, rest))
+
+    def store(self, index, values, rows=None):
+        self[index if rows is None else (index, rows)] = values
 
+    def __setitem__(self, indexes, change):
+        index, rest = self.split(indexes)
+        prefetcher = self.root.prefetcher if self.root else None
+        if isinstance(index, (int, np.integer)):
+            variable, handle = self.part(index), self.variables[index]
+            with LIBRARY_LOCK:
+                variable[(rest if handle.shape[0] > 1 else (0,) + rest)
+                         or slice(None)] = change
+                variable.sync()
+                if prefetcher:
+                    prefetcher.discard(self.name, index)
+            return
+        if prefetcher:
+            prefetcher.cancel()
+        with LIBRARY_LOCK:
+            pack = self.pack()
+            pack.__setitem__(indexes, change)
+            varstmp = np.vsplit(pack, pack.shape[0])
+            for i in range(len(varstmp)):
+                self.part(i)[:] = varstmp[i]
+            self.sync()
+
+
+class Expression(Operators):
+
+    __slots__ = ('function', 'operands')
+
+    def __init__(self, function, operands):
+        self.function = function
+        self.operands = tuple(operands)
+
+    def __nonzero__(self):
+        raise Exception('The truth value of an expression is ambiguous, '
+                        'use compute.')
+
+    __bool__ = __nonzero__
+
+    def leaves(self):
+        leaves = []
+        for operand in self.operands:
+            found = (operand.leaves() if isinstance(operand, Expression) else
+                     [operand] if isinstance(operand, NCVariable) else [])
+            leaves.extend([leaf for leaf in found
+                           if all(leaf is not other for other in leaves)])
+        return leaves
+
+    def constants(self):
+        found = []
+        for operand in self.operands:
+            found.extend(operand.constants() if isinstance(operand, Expression)
+                         else [] if isinstance(operand, NCVariable)
+                         else [operand])
+        return found
+
+    def evaluate(self, values):
+        return self.function(*[operand.evaluate(values)
+                               if isinstance(operand, Expression)
+                               else values.get(id(operand), operand)
+                               for operand in self.operands])
+
+    def slabs(self, index, leaves):
+        # split the block of a file along its first axis, keeping the rows of
+        # all the variables of each slab within the EXPRESSION_MEMORY.
+        shapes = [leaf.block_shape(index) for leaf in leaves]
+        ndim = len(shapes[0])
+        if (not ndim or {len(s) for s in shapes} != {ndim} or
+                len({s[0] for s in shapes}) != 1 or
+                any(np.ndim(c) >= ndim for c in self.constants())):
+            return [None]
+        row = sum(int(np.prod(s[1:])) * np.dtype(leaf.dtype).itemsize
+                  for s, leaf in zip(shapes, leaves))
+        rows, total = max(1, EXPRESSION_MEMORY // max(row, 1)), shapes[0][0]
+        return ([None] if rows >= total else
+                [slice(start, min(start + rows, total))
+                 for start in range(0, total, rows)])
+
+    def block(self, slab, leaves, out):
+        # each variable is read once by slab (rows of a file in a package).
+        index, rows = slab
+        key = index if rows is None else (index, rows)
+        result = self.evaluate({id(leaf): leaf[key] for leaf in leaves})
+        if isinstance(out, NCVariable):
+            out.store(index, result, rows)
+        elif out is not None:
+            out[key] = result
+        return result if out is None else None
+
+    def compute(self, out=None, workers=1):
+        leaves = self.leaves()
+        blocks = {len(leaf.variables) for leaf in leaves}
+        if len(blocks) != 1:
+            raise Exception('The variables of the expression should have '
+                            'the same amount of files.')
+        calculate = lambda slab: self.block(slab, leaves, out)
+        slabs = [(index, rows) for index in range(blocks.pop())
+                 for rows in self.slabs(index, leaves)]
+        pool = ThreadPool(workers) if workers > 1 else None
+        results = (pool.map(calculate, slabs) if pool
+                   else list(map(calculate, slabs)))
+        if pool:
+            pool.close()
+            pool.join()
+        if out is not None:
+            return out
+        parts = OrderedDict()
+        for (index, _), result in zip(slabs, results):
+            parts.setdefault(index, []).append(result)
+        return np.array([np.concatenate(p) if len(p) > 1 else p[0]
+                         for p in parts.values()])
+
+
+class Planner(object):
+
+    def __init__(self, memory):
+        super(Planner, self).__init__()
+        self.memory = memory
+        # the blocks in least recently used order, and indexed by variable.
+        self.cache = OrderedDict()
+        self.index = {}
+        self.size = 0
+        # requested: bytes asked by the reads, planned: bytes of the chunks
+        # touched by the reads, fetched: bytes read from the library on the
+        # cache misses (an estimate of the decompressed bytes).
+        self.stats = {'requested': 0, 'planned': 0, 'fetched': 0}
+
+    def plan(self, handle, indexes):
+        chunks = handle.chunking()
+        indexes = indexes if indexes.__class__ is tuple else (indexes,)
+        basic = all(isinstance(i, (int, np.integer, slice)) and
+                    not isinstance(i, bool) for i in indexes)
+        if (not isinstance(chunks, list) or not basic or
+                len(indexes) > handle.ndim):
+            return None
+        indexes = indexes + (slice(None),) * (handle.ndim - len(indexes))
+        bounds, aligned = [], []
+        for index, size, chunk in zip(indexes, handle.shape, chunks):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(size)
+                if step != 1 or start >= stop:
+                    return None
+            else:
+                start = index + size if index < 0 else index
+                stop = start + 1
+                if not 0 <= start < size:
+                    return None
+            bounds.append((start, stop))
+            aligned.append((start // chunk * chunk,
+                            min(-(-stop // chunk) * chunk, size)))
+        return indexes, bounds, aligned
+
+    def read(self, handle, indexes):
+        plan = self.plan(handle, indexes)
+        if not plan:
+            return handle[indexes]
+        indexes, bounds, aligned = plan
+        count = lambda ranges: (int(np.prod([e - s for s, e in ranges])) *
+                                np.dtype(handle.dtype).itemsize)
+        self.stats['requested'] += count(bounds)
+        self.stats['planned'] += count(aligned)
+        tag = (id(handle.group()), handle.name)
+        block = self.lookup(tag, bounds)
+        chunk = count([(0, size) for size in handle.chunking()])
+        if not block and (count(aligned) > self.memory or count(aligned) >
+                          max(PLANNER_OVERREAD * count(bounds), chunk)):
+            # the aligned block wouldn't be cached, or mostly wasted.
+            self.stats['fetched'] += count(bounds)
+            return handle[indexes]
+        if not block:
+            block = (aligned, handle[tuple(slice(*a) for a in aligned)])
+            self.stats['fetched'] += count(aligned)
+            self.store(tag, block)
+        origin, values = block
+        local = tuple((slice(start - o, stop - o)
+                       if isinstance(index, slice) else start - o)
+                      for index, (start, stop), (o, _)
+                      in zip(indexes, bounds, origin))
+        return values[local].copy()
+
+    def lookup(self, tag, bounds):
+        inside = lambda aligned: all(a <= s and e <= b for (s, e), (a, b)
+                                     in zip(bounds, aligned))
+        for aligned, block in self.index.get(tag, {}).items():
+            if inside(aligned):
+                key = tag + (aligned,)
+                self.cache[key] = self.cache.pop(key)
+                return block
+
+    def store(self, tag, block):
+        nbytes = block[1].nbytes
+        if nbytes > self.memory:
+            return
+        aligned = tuple(block[0])
+        self.cache[tag + (aligned,)] = block
+        self.index.setdefault(tag, {})[aligned] = block
+        self.size += nbytes
+        while self.size > self.memory:
+            self.remove(next(iter(self.cache)))
+
+    def remove(self, key):
+        tag, aligned = key[:2], key[2]
+        self.size -= self.cache.pop(key)[1].nbytes
+        del self.index[tag][aligned]
+        if not self.index[tag]:
+            del self.index[tag]
+
+    def invalidate(self, handle):
+        tag = (id(handle.group()), handle.name)
+        for aligned in list(self.index.get(tag, {})):
+            self.remove(tag + (aligned,))
+
+
+class Prefetcher(object):
+
+    def __init__(self, depth, memory):
+        super(Prefetcher, self).__init__()
+        self.depth = depth
+        self.memory = memory
+        self.cache = {}
+        self.size = 0
+        self.pending = set()
+        # the last index and generation of each request, to cancel them
+        # independently.
+        self.last = {}
+        self.generations = {}
+        self.generation = 0
+        self.condition = threading.Condition()
+        self.queue = Queue()
+        self.thread = None
+
+    def read(self, variable, index, rest):
+        # the requests are identified by variable, window and hyperslab.
+        tag = (variable.name, repr(sorted(variable.window.items())),
+               repr(rest))
+        key = tag + (index,)
+        with self.condition:
+            while key in self.pending:
+                self.condition.wait()
+            sequential = self.last.get(tag) == index - 1
+            if not sequential:
+                self.cancel(tag)
+            self.last[tag] = index
+            values = self.cache.pop(key, None)
+            self.size -= values.nbytes if values is not None else 0
+        if values is None:
+            values = variable.fetch(index, rest)
+        if sequential and self.depth:
+            self.schedule(variable, index, rest, tag)
+        return values
+
+    def schedule(self, variable, index, rest, tag):
+        with self.condition:
+            last = min(index + self.depth, len(variable.variables) - 1)
+            for following in range(index + 1, last + 1):
+                key = tag + (following,)
+                if self.size >= self.memory:
+                    break
+                if key not in self.cache and key not in self.pending:
+                    self.pending.add(key)
+                    self.queue.put((self.current(tag), key, variable,
+                                    following, rest))
+            if not self.thread:
+                self.thread = threading.Thread(target=self.work)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def work(self):
+        for task in iter(self.queue.get, None):
+            generation, key, variable, index, rest = task
+            values = None
+            # the lock keeps the writes from interleaving with the caching.
+            with LIBRARY_LOCK:
+                if generation == self.current(key[:-1]):
+                    try:
+                        values = variable.fetch(index, rest)
+                    except Exception:
+                        values = None
+                with self.condition:
+                    self.pending.discard(key)
+                    if (values is not None and
+                            generation == self.current(key[:-1]) and
+                            self.size + values.nbytes <= self.memory):
+                        self.cache[key] = values
+                        self.size += values.nbytes
+                    self.condition.notify_all()
+
+    def discard(self, name, index):
+        with self.condition:
+            for key in [k for k in self.cache
+                        if k[0] == name and k[-1] == index]:
+                self.size -= self.cache.pop(key).nbytes
+
+    def current(self, tag):
+        return self.generation, self.generations.get(tag, 0)
+
+    def cancel(self, tag=None):
+        # cancel the requests of a tag, or all of them.
+        with self.condition:
+            if tag is None:
+                self.generation += 1
+                self.last.clear()
+            else:
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+                self.last.pop(tag, None)
+            for key in [k for k in self.cache
+                        if tag is None or k[:-1] == tag]:
+                self.size -= self.cache.pop(key).nbytes
 
-def open(pattern):
+    def close(self):
+        self.cancel()
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def serialized(function, *args):
+    with LIBRARY_LOCK:
+        return function(*args)
+
+
+def read_block(source, name, step, delta):
+    variable = source.variables[name]
+    variable.set_auto_maskandscale(False)
+    if step is None:
+        values = np.array(variable[:])
+        for block, changed in delta.get(name, {}).items():
+            values[block] = changed
+    else:
+        values = np.array(delta[name][step] if step in delta.get(name, {})
+                          else variable[step])
+    return values
+
+
+def export_group(task):
+    output, units, names, options, deltas = task
+    first = dataset(units[0][0], mode='r')
+    if (len({filename for filename, _ in units}) > 1 and
+            not any(d.isunlimited() for d in first.dimensions.values())):
+        first.close()
+        raise Exception('The files of %s can not be joined without an '
+                        'unlimited dimension.' % output)
+    root = dataset(output, mode='w', format='NETCDF4')
+    root.setncatts({a: first.getncattr(a) for a in first.ncattrs()})
+    names = names if names else list(first.variables.keys())
+    used = {d for name in names for d in first.variables[name].dimensions}
+    for name in [d for d in first.dimensions if d in used]:
+        dimension = first.dimensions[name]
+        root.createDimension(name, (None if dimension.isunlimited()
+                                    else len(dimension)))
+    unlimited = {d for d in used if first.dimensions[d].isunlimited()}
+    steady = []
+    for name in names:
+        source = first.variables[name]
+        attributes = {a: source.getncattr(a) for a in source.ncattrs()}
+        fill_value = attributes.pop('_FillValue', None)
+        variable = root.createVariable(name, source.dtype, source.dimensions,
+                                       fill_value=fill_value, **options)
+        variable.set_auto_maskandscale(False)
+        variable.setncatts(attributes)
+        if not source.dimensions or source.dimensions[0] not in unlimited:
+            steady.append(name)
+            variable[:] = read_block(first, name, None,
+                                     deltas.get(units[0][0], {}))
+    first.close()
+    varying = [name for name in names if name not in steady]
+    source, current = None, None
+    for offset, (filename, step) in enumerate(units):
+        if filename != current:
+            if source:
+                source.close()
+            source, current = dataset(filename, mode='r'), filename
+        for name in varying:
+            root.variables[name][offset] = read_block(
+                source, name, step, deltas.get(filename, {}))
+    source.close()
+    root.close()
+    return output
+
+
+NC_TYPES = {1: 'i1', 2: 'S1', 3: 'i2', 4: 'i4', 5: 'f4', 6: 'f8', 7: 'u1',
+            8: 'u2', 9: 'u4', 10: 'i8', 11: 'u8'}
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+class ClassicHeader(object):
+
+    def __init__(self, filehandler, version):
+        super(ClassicHeader, self).__init__()
+        self.file = filehandler
+        # the CDF-5 format use 64 bits counters and the CDF-2 64 bits offsets.
+        self.count = 'q' if version == 5 else 'i'
+        self.offset = 'i' if version == 1 else 'q'
+
+    def unpack(self, fmt):
+        fmt = '>' + fmt
+        return struct.unpack(fmt, self.file.read(struct.calcsize(fmt)))[0]
+
+    def skip(self, size):
+        self.file.read(size + (4 - size % 4) % 4)
+
+    def name(self):
+        size = self.unpack(self.count)
+        name = self.file.read(size).decode('utf-8')
+        self.file.read((4 - size % 4) % 4)
+        return name
+
+    def items(self, tag):
+        found, size = self.unpack('i'), self.unpack(self.count)
+        if found not in [0, tag]:
+            raise Exception('The netCDF header is corrupted.')
+        return size
+
+    def skip_attributes(self):
+        for _ in range(self.items(0x0C)):
+            self.name()
+            vtype = NC_TYPES[self.unpack('i')]
+            self.skip(self.unpack(self.count) * np.dtype(vtype).itemsize)
+
+    def read(self):
+        records = self.unpack(self.count)
+        dims, unlimited = [], []
+        for _ in range(self.items(0x0A)):
+            name, size = self.name(), self.unpack(self.count)
+            if not size:
+                size = records
+                unlimited.append(name)
+            dims.append((name, size))
+        self.skip_attributes()
+        variables = OrderedDict()
+        for _ in range(self.items(0x0B)):
+            name = self.name()
+            ids = [self.unpack(self.count)
+                   for _ in range(self.unpack(self.count))]
+            variables[name] = tuple(dims[i][0] for i in ids)
+            self.skip_attributes()
+            self.unpack('i')
+            self.unpack(self.count)
+            self.unpack(self.offset)
+        return {'dimensions': OrderedDict(dims), 'unlimited': unlimited,
+                'variables': variables}
+
+
+def read_hdf5_header(filename):
+    try:
+        import h5py
+    except ImportError:
+        return read_dataset_header(filename)
+    with h5py.File(filename, 'r') as root:
+        names = []
+        try:
+            root.id.links.iterate(names.append,
+                                  idx_type=h5py.h5.INDEX_CRT_ORDER)
+        except Exception:
+            names = list(root.keys())
+        items = [(name, root[name]) for name in names
+                 if isinstance(root[name], h5py.Dataset)]
+        scales = OrderedDict((name, item) for name, item in items
+                             if item.attrs.get('CLASS') == b'DIMENSION_SCALE')
+        # without the netCDF ids the dimensions keep the creation order.
+        ids = {item.attrs.get('_Netcdf4Dimid', position): name
+               for position, (name, item) in enumerate(scales.items())}
+        dimensions = [ids[dimid] for dimid in sorted(ids)]
+        variables = OrderedDict()
+        for name, item in items:
+            attributes = item.attrs
+            if item.shape == ():
+                dims = []
+            elif '_Netcdf4Coordinates' in attributes:
+                dims = [ids[i] for i in attributes['_Netcdf4Coordinates']]
+            elif 'DIMENSION_LIST' in attributes:
+                dims = [root[refs[0]].name.split('/')[-1]
+                        for refs in attributes['DIMENSION_LIST']]
+            else:
+                dims = [name]
+            if not (attributes.get('NAME', b'').startswith(
+                    b'This is a netCDF dimension but not a netCDF variable')):
+                variables[name] = tuple(dims)
+        sizes = {}
+        for name, item in items:
+            for dim, size in zip(variables.get(name, [name]), item.shape):
+                sizes[dim] = max(size, sizes.get(dim, 0))
+        return {'dimensions': OrderedDict((name, sizes[name])
+                                          for name in dimensions),
+                'unlimited': [name for name in dimensions
+                              if scales[name].maxshape[0] is None],
+                'variables': variables}
+
+
+def read_dataset_header(filename):
+    root = dataset(filename, mode='r')
+    header = {'dimensions': OrderedDict((name, len(dim)) for name, dim
+                                        in root.dimensions.items()),
+              'unlimited': [name for name, dim in root.dimensions.items()
+                            if dim.isunlimited()],
+              'variables': OrderedDict((name, var.dimensions) for name, var
+                                       in root.variables.items())}
+    root.close()
+    return header
+
+
+def read_header(filename):
+    with io.open(filename, 'rb') as filehandler:
+        signature = filehandler.read(8)
+        if signature[:3] == b'CDF':
+            version = struct.unpack('>B', signature[3:4])[0]
+            filehandler.seek(4)
+            return ClassicHeader(filehandler, version).read()
+    return (read_hdf5_header(filename) if signature == HDF5_SIGNATURE
+            else read_dataset_header(filename))
+
+
+def umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+def commit(staged):
+    # journal the renames in each directory, so a commit interrupted by a
+    # crash is completed by the next transaction over the files.
+    if not staged:
+        return
+    for r in [r for r in staged if r.is_new]:
+        # mkstemp creates the temporary files only for the owner.
+        os.chmod(r.temporary, 0o666 & ~umask())
+    pairs = [(os.path.abspath(r.temporary), os.path.abspath(r.files[0]))
+             for r in staged]
+    journals = sorted({os.path.join(os.path.dirname(target),
+                                    JOURNAL % os.getpid())
+                       for _, target in pairs})
+    content = ''.join('%s\t%s\n' % pair for pair in pairs)
+    for journal in journals:
+        with io.open(journal + '.part', 'wb') as filehandler:
+            filehandler.write(content)
+            filehandler.flush()
+            os.fsync(filehandler.fileno())
+        os.rename(journal + '.part', journal)
+    list(map(NCFile.replace, staged))
+    list(map(os.remove, journals))
+
+
+def recover(files):
+    # complete the commits interrupted by a crash, and remove the copies
+    # staged by the processes that died before their commit.
+    paths = [os.path.abspath(f) for f in files]
+    for directory in sorted({os.path.dirname(p) for p in paths}):
+        pattern = os.path.join(directory, JOURNAL.replace('%i', '*'))
+        for journal in glob(pattern) + glob(pattern + '.part'):
+            name = os.path.basename(journal)
+            if not os.path.exists(journal) or alive(int(name.split('.')[2])):
+                continue
+            with io.open(journal, 'rb') as filehandler:
+                pairs = [line.split('\t') for line in
+                         filehandler.read().splitlines() if line]
+            if not journal.endswith('.part'):
+                for temporary, target in pairs:
+                    if os.path.exists(temporary):
+                        os.rename(temporary, target)
+            for copy in {os.path.join(os.path.dirname(t), name)
+                         for _, t in pairs} | {journal}:
+                if os.path.exists(copy):
+                    os.remove(copy)
+    for path in paths:
+        directory, name = os.path.split(path)
+        prefix = os.path.join(directory, '.%s.' % name)
+        for temporary in glob(prefix + '*.tmp'):
+            pid = temporary[len(prefix):].split('.')[0]
+            if pid.isdigit() and not alive(int(pid)):
+                os.remove(temporary)
+
+
+def verify(filename):
+    root = dataset(filename, mode='r')
+    try:
+        for variable in root.variables.values():
+            if (variable.filters() or {}).get('fletcher32'):
+                # the HDF5 library checks the checksum of each chunk read.
+                variable[:]
+    except Exception:
+        raise Exception('The checksum of %s has failed.' % filename)
+    finally:
+        root.close()
+
+
+def open(pattern, overlay=False, transaction=False, checksum=False):
     """
     Return a root descriptor to work with one or multiple NetCDF files.
 
     Keyword arguments:
     pattern -- a list of filenames or a string pattern.
+    overlay -- keep the changes over read only files in memory, and merge
+    them with the content of the files on each read (default False)
+    transaction -- write the changes into temporary copies of the files,
+    which replace the modified files when the root is closed. Opening a
+    transaction also completes the commits interrupted by a crash and removes
+    the copies left by dead processes over the same files (default False)
+    checksum -- add a fletcher32 checksum to the created variables, and
+    verify them before replacing the files of a transaction (default False)
     """
-    root = NCObject.open(pattern)
+    root = NCObject.open(pattern, overlay, transaction, checksum)
     return root, root.is_new
 
 
@@ -297,6 +1332,59 @@ def getvar(root, name, vtype='', dimensions=(), digits=0, fill_value=None,
     return root.getvar(name, vtype, dimensions, digits, fill_value, source)
 
 
+def subset(root, bbox):
+    """
+    Return a view of a NCFile or NCPackage instance restricted to the minimal
+    (yc, xc) window that contains a lat/lon bounding box. The window is
+    computed once per root and every variable obtained through the view only
+    reads and writes that hyperslab.
+
+    Keyword arguments:
+    root -- the root descriptor returned by the 'open' function
+    bbox -- the tuple (lat_min, lat_max, lon_min, lon_max)
+    """
+    return root.subset(bbox)
+
+
+def export(root, out_pattern, group_by=None, variables=None, storage=None,
+           workers=1, progress=None):
+    """
+    Stream the variables of a NCFile or NCPackage instance into a new set of
+    files. Each time step (a position of the unlimited dimension of each file)
+    is assigned to an output file, and only one step of each variable is kept
+    in memory. Return the list of written filenames.
+
+    Keyword arguments:
+    root -- the root descriptor returned by the 'open' function
+    out_pattern -- the output filename, ex 'monthly_%s.nc' when using group_by
+    group_by -- a function that receive the filename and step and return the
+    key used to fill the out_pattern (default None)
+    variables -- the list of variable names to export (default all)
+    storage -- the creation options of the variables, ex {'complevel': 9}
+    (default {'zlib': True})
+    workers -- the number of processes writing files in parallel (default 1)
+    progress -- a function that receive the written and total files
+    (default None)
+    """
+    return root.export(out_pattern, group_by, variables, storage, workers,
+                       progress)
+
+
+def inventory(pattern):
+    """
+    Return the dimensions and variables of one or multiple NetCDF files,
+    reading only the headers of the files (without loading the netCDF4
+    library for the NETCDF3 formats). The result is a dictionary with the
+    'dimensions' sizes, the 'unlimited' dimension names and the 'variables'
+    dimensions of each filename.
+
+    Keyword arguments:
+    pattern -- a list of filenames or a string pattern.
+    """
+    files, _ = NCObject.distill(pattern)
+    return {filename: read_header(filename) for filename in files}
+
+
 def sync(root):
     """
     Force the root descriptor to synchronize writing the buffers to the disk.
@@ -309,7 +1397,10 @@ def sync(root):
 
 def close(root):
     """
-    Close the root descriptor and write the buffer to the disk.
+    Close the root descriptor and write the buffer to the disk. When the root
+    was opened as a transaction, the modified files are replaced by their
+    temporary copies. The replacements are journaled, so if the process dies
+    in the middle of them the next transaction over the files completes them.
 
     Keyword arguments:
     root -- the root descriptor returned by the 'open' function
@@ -317,8 +1408,22 @@ def close(root):
     root.close()
 
 
+def rollback(root):
+    """
+    Close the root descriptor and discard the changes of a transaction.
+
+    Keyword arguments:
+    root -- the root descriptor returned by the 'open' function
+    """
+    root.rollback()
+
+
 @contextmanager
-def loader(pattern):
-    root, _ = open(pattern)
-    yield root
+def loader(pattern, overlay=False, transaction=False, checksum=False):
+    root, _ = open(pattern, overlay, transaction, checksum)
+    try:
+        yield root
+    except Exception:
+        rollback(root)
+        raise
     close(root)
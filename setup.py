@@ -40,7 +40,7 @@ BINARIES = {
         'name': 'hdf5-%s',
         'url': 'http://www.hdfgroup.org/ftp/HDF5/releases/%s/src',
         'compile': {
-            'depends': ['pyandoc==0.0.1', 'numpy==1.8.0'],
+            'depends': ['pyandoc==0.0.1', 'numpy==1.13.3'],
             'config': {
                 'pre': '',
                 'post': '--prefix=/usr/local --enable-shared --enable-hl',
@@ -3,6 +3,9 @@ from netCDF4 import Dataset
 from netcdf import netcdf as nc
 import os
 import stat
+from glob import glob
+import subprocess
+import sys
 import numpy as np
 
 
@@ -170,6 +173,39 @@ class TestNetcdf(unittest.TestCase):
         with self.assertRaisesRegexp(RuntimeError, u'NetCDF: Not a valid ID'):
             nc.close(root)
 
+    def test_import_without_netcdf4(self):
+        # check if the netCDF4 library is loaded on the first data access.
+        code = ('import sys; from netcdf import netcdf as nc; '
+                'nc.inventory("unittest00.nc"); '
+                'print("netCDF4" in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEquals(output.strip(), b'False')
+
+    def test_inventory_of_multiple_formats(self):
+        # check if read the header of the classic files.
+        headers = nc.inventory('unittest0*.nc')
+        self.assertEquals(sorted(headers.keys()),
+                          ['unittest0%i.nc' % i for i in range(5)])
+        header = headers['unittest00.nc']
+        self.assertEquals(dict(header['dimensions']),
+                          {'auditCount': 2, 'auditSize': 80, 'xc': 200,
+                           'yc': 100, 'time': 1})
+        self.assertEquals(header['unlimited'], ['time'])
+        self.assertEquals(list(header['variables'].keys()),
+                          ['time', 'lat', 'lon', 'data', 'auditTrail'])
+        self.assertEquals(header['variables']['data'], ('time', 'yc', 'xc'))
+        # check if read the header of the HDF5 files.
+        source = nc.open('unittest00.nc')[0]
+        root = nc.open('unittest_hdf5.nc')[0]
+        nc.getvar(root, 'copied_data', source=nc.getvar(source, 'data'))
+        nc.getvar(root, 'scale', 'f4')[:] = 2.
+        nc.close(root)
+        nc.close(source)
+        header = nc.inventory('unittest_hdf5.nc')['unittest_hdf5.nc']
+        self.assertEquals(header, nc.read_dataset_header('unittest_hdf5.nc'))
+        self.assertEquals(len(header['variables']), 2)
+        self.assertEquals(header['variables']['scale'], ())
+
     def test_get_existing_dim_single_file(self):
         # check if get the dimension in a single file.
         root = nc.open('unittest00.nc')[0]
@@ -198,6 +234,21 @@ class TestNetcdf(unittest.TestCase):
         self.assertTrue(root.has_dimension('the_12th_dimension'))
         nc.close(root)
 
+    def test_dimensions_registry_multiple_file(self):
+        # check if the registry is built once and updated on creation.
+        root = nc.open('unittest0*.nc')[0]
+        registry = root.dimensions
+        self.assertIs(root.dimensions, registry)
+        self.assertEquals(len(registry['xc']), 5)
+        self.assertTrue(all(d.isunlimited() for d in registry['time']))
+        nc.getdim(root, 'the_12th_dimension', 123)
+        self.assertIs(root.dimensions, registry)
+        self.assertEquals([len(d) for d in registry['the_12th_dimension']],
+                          [123] * 5)
+        self.assertTrue(all(r.has_dimension('the_12th_dimension')
+                            for r in root.roots))
+        nc.close(root)
+
     def test_get_existing_var_single_file(self):
         # check if get the variable in a single file.
         root = nc.open('unittest00.nc')[0]
@@ -250,6 +301,28 @@ class TestNetcdf(unittest.TestCase):
         self.assertTrue(are_equals.all())
         nc.close(root)
 
+    def test_variables_cache_is_bounded(self):
+        root = nc.open('unittest0*.nc')[0]
+        size = nc.VARIABLES_CACHE_SIZE
+        nc.VARIABLES_CACHE_SIZE = 2
+        try:
+            data = nc.getvar(root, 'data')
+            nc.getvar(root, 'lat')
+            # check if the access refresh the variable in the cache.
+            self.assertIs(nc.getvar(root, 'data'), data)
+            nc.getvar(root, 'lon')
+            self.assertEquals(list(root.variables.keys()), ['data', 'lon'])
+        finally:
+            nc.VARIABLES_CACHE_SIZE = size
+        # check if the wrappers are compact and keep only the handles.
+        self.assertTrue(all('__dict__' not in vars(cls)
+                            for cls in type(data).__mro__))
+        self.assertEquals(data.variables.__class__, tuple)
+        self.assertFalse(any(isinstance(v, nc.NCVariable)
+                             for v in data.variables))
+        self.assertEquals(root.roots[0].variables, {})
+        nc.close(root)
+
     def test_single_file_var_operations(self):
         # check if get and set the numpy matrix.
         root = nc.open('unittest00.nc')[0]
@@ -314,6 +387,240 @@ class TestNetcdf(unittest.TestCase):
         self.assertTrue(var, tmp + 1)
         nc.close(root)
 
+    def test_prefetch_sequential_reads(self):
+        root = nc.open('unittest0*.nc')[0]
+        var = nc.getvar(root, 'data')
+        var[:] = np.vstack([np.zeros((1, 100, 200)) + i for i in range(5)])
+        pack = var[:]
+        prefetcher = root.prefetcher
+        # check if the reading of the next files start after 2 steps.
+        self.assertTrue((var[0, 10:20] == pack[0, 10:20]).all())
+        self.assertTrue((var[1, 10:20] == pack[1, 10:20]).all())
+        # check if the whole reads wait the files being prefetched.
+        self.assertEquals(var.shape, (5, 100, 200))
+        with prefetcher.condition:
+            while prefetcher.pending:
+                prefetcher.condition.wait()
+        self.assertEquals(sorted(k[-1] for k in prefetcher.cache), [2, 3])
+        self.assertTrue((var[2, 10:20] == pack[2, 10:20]).all())
+        self.assertTrue((var[-2, 10:20] == pack[3, 10:20]).all())
+        # check if a random access cancel the prefetched files.
+        self.assertTrue((var[0, 10:20] == pack[0, 10:20]).all())
+        self.assertEquals(prefetcher.cache, {})
+        # check if the interleaved variables are prefetched independently.
+        lat = nc.getvar(root, 'lat')
+        for index in range(2):
+            self.assertTrue((var[index, 5] == pack[index, 5]).all())
+            lat[index, 5]
+        with prefetcher.condition:
+            while prefetcher.pending:
+                prefetcher.condition.wait()
+        self.assertEquals(sorted((k[0], k[-1]) for k in prefetcher.cache),
+                          [('data', 2), ('data', 3), ('lat', 2), ('lat', 3)])
+        nc.close(root)
+        self.assertIsNone(prefetcher.thread)
+
+    def test_chunk_aligned_reads(self):
+        ref = Dataset('unittest_chunked.nc', mode='w', format='NETCDF4')
+        ref.createDimension('time')
+        ref.createDimension('yc', 100)
+        ref.createDimension('xc', 200)
+        var = ref.createVariable('data', 'f4', ('time', 'yc', 'xc'),
+                                 zlib=True, chunksizes=(1, 10, 20))
+        var[0] = np.arange(100 * 200).reshape(100, 200)
+        ref.close()
+        root = nc.open('unittest_chunked.nc')[0]
+        var = nc.getvar(root, 'data')
+        pack = var[:]
+        # check if the full read was kept, and discard it.
+        self.assertEquals(root.planner.size, 100 * 200 * 4)
+        root.planner.invalidate(var.variables[0])
+        stats = root.planner.stats
+        stats.update({'requested': 0, 'planned': 0, 'fetched': 0})
+        # check if the second read reuse the chunks of the first one.
+        self.assertTrue((var[0, 5:15, 5:25] == pack[0, 5:15, 5:25]).all())
+        self.assertTrue((var[0, 12:18, 10:30] == pack[0, 12:18, 10:30]).all())
+        self.assertEquals(stats, {'requested': (10 * 20 + 6 * 20) * 4,
+                                  'planned': (20 * 40 + 10 * 40) * 4,
+                                  'fetched': 20 * 40 * 4})
+        # check if the writes invalidate the chunks.
+        var[0, 12, 10] = -1.
+        self.assertEquals(var[0, 12, 10], -1.)
+        self.assertEquals(stats['fetched'], (20 * 40 + 10 * 20) * 4)
+        self.assertEquals(len(root.planner.index), 1)
+        # check if read directly the blocks too large to be aligned.
+        size = root.planner.size
+        stats.update({'requested': 0, 'planned': 0, 'fetched': 0})
+        self.assertTrue((var[0, :, 5] == pack[0, :, 5]).all())
+        root.planner.memory = 1000
+        self.assertTrue((var[0, 40:60, 40:80] == pack[0, 40:60, 40:80]).all())
+        self.assertEquals(stats, {'requested': (100 + 20 * 40) * 4,
+                                  'planned': (100 * 20 + 20 * 40) * 4,
+                                  'fetched': (100 + 20 * 40) * 4})
+        self.assertEquals(root.planner.size, size)
+        nc.close(root)
+
+    def test_lazy_expressions(self):
+        # check if evaluate an expression over a single file.
+        root = nc.open('unittest00.nc')[0]
+        data = nc.getvar(root, 'data')
+        data[:] = data[:] + 1
+        values = data[:]
+        expression = data ** 3 + np.cos(data) * 2
+        self.assertEquals(expression.__class__, nc.Expression)
+        expression.compute(out=data)
+        self.assertTrue(np.allclose(data[:], values ** 3 +
+                                    np.cos(values) * 2))
+        nc.close(root)
+        # check if evaluate an expression over multiple files.
+        root = nc.open('unittest0*.nc')[0]
+        data = nc.getvar(root, 'data')
+        lat = nc.getvar(root, 'lat')
+        result = nc.getvar(root, 'result', 'f4', ('time', 'yc', 'xc'))
+        values = data[:]
+        expression = (-data + 10) / (lat * 2.)
+        self.assertTrue(np.allclose(expression.compute(),
+                                    (-values + 10) / 2.))
+        expression.compute(out=result, workers=3)
+        self.assertTrue(np.allclose(result[:], (-values + 10) / 2.))
+        # check if split the files in slabs bounded by the memory.
+        memory = nc.EXPRESSION_MEMORY
+        nc.EXPRESSION_MEMORY = 25 * 200 * 4 * 2
+        try:
+            self.assertEquals(expression.slabs(0, expression.leaves()),
+                              [slice(i, i + 25) for i in range(0, 100, 25)])
+            self.assertTrue(np.allclose(expression.compute(),
+                                        (-values + 10) / 2.))
+            (expression * 2).compute(out=result, workers=3)
+            self.assertTrue(np.allclose(result[:], (-values + 10)))
+        finally:
+            nc.EXPRESSION_MEMORY = memory
+        # check if the comparisons with arrays are evaluated.
+        self.assertTrue((values == data).all())
+        self.assertFalse((values + 99 == data).any())
+        with self.assertRaisesRegexp(Exception, u'The truth value of an '
+                                     'expression is ambiguous'):
+            bool(data + 1)
+        single = nc.open('unittest00.nc')[0]
+        with self.assertRaisesRegexp(Exception, u'The variables of the '
+                                     'expression should have the same '
+                                     'amount of files.'):
+            (data + nc.getvar(single, 'data')).compute()
+        nc.close(single)
+        nc.close(root)
+        # check if evaluate an expression over a file with many steps.
+        ref = Dataset('unittest_monthly.nc', mode='w', format='NETCDF4')
+        ref.createDimension('time')
+        ref.createDimension('yc', 10)
+        ref.createDimension('xc', 20)
+        ref.createVariable('data', 'f4', ('time', 'yc', 'xc'))[:] = (
+            np.arange(3 * 10 * 20).reshape(3, 10, 20))
+        ref.close()
+        with nc.loader('unittest_monthly.nc') as root:
+            data = nc.getvar(root, 'data')
+            values = data[:]
+            (data * 2 + 1).compute(out=data)
+            self.assertTrue((data[:] == values * 2 + 1).all())
+            # check if compute each step on its own slab.
+            memory = nc.EXPRESSION_MEMORY
+            nc.EXPRESSION_MEMORY = 10 * 20 * 4
+            try:
+                expression = data - 1
+                self.assertEquals(len(expression.slabs(0, [data])), 3)
+                self.assertTrue((expression.compute() == values * 2).all())
+                expression.compute(out=data)
+                self.assertTrue((data[:] == values * 2).all())
+            finally:
+                nc.EXPRESSION_MEMORY = memory
+
+    def test_transaction_commit_and_rollback(self):
+        # check if the changes are written into temporary copies.
+        root = nc.open('unittest0*.nc', transaction=True)[0]
+        self.assertEquals(len(glob('.unittest0*.nc.*.tmp')), 5)
+        data = nc.getvar(root, 'data')
+        data[:] = data[:] + 1
+        nc.sync(root)
+        original = nc.open('unittest00.nc')[0]
+        self.assertTrue((nc.getvar(original, 'data')[:] == 1.).all())
+        nc.close(original)
+        # check if export the staged changes.
+        nc.export(root, 'unittest_staged.nc', variables=['data'])
+        with nc.loader('unittest_staged.nc') as exported:
+            self.assertTrue((nc.getvar(exported, 'data')[:] == 2.).all())
+        # check if the discarded changes don't modify the files.
+        nc.rollback(root)
+        self.assertEquals(glob('.unittest0*.nc.*.tmp'), [])
+        with nc.loader('unittest0*.nc') as root:
+            self.assertTrue((nc.getvar(root, 'data')[:] == 1.).all())
+        with self.assertRaisesRegexp(Exception, u'Interrupted'):
+            with nc.loader('unittest0*.nc', transaction=True) as root:
+                nc.getvar(root, 'data')[:] = 3.
+                raise Exception('Interrupted')
+        # check if the committed changes replace the files.
+        with nc.loader('unittest0*.nc', transaction=True) as root:
+            nc.getvar(root, 'data')[:] = 2.
+        self.assertEquals(glob('.unittest0*.nc.*.tmp'), [])
+        with nc.loader('unittest0*.nc') as root:
+            self.assertTrue((nc.getvar(root, 'data')[:] == 2.).all())
+        # check if only the modified files are replaced.
+        inodes = [os.stat(f).st_ino for f in sorted(glob('unittest0*.nc'))]
+        with nc.loader('unittest0*.nc', transaction=True) as root:
+            nc.getvar(root, 'data')[1] = 3.
+        self.assertEquals([os.stat(f).st_ino != i for f, i in
+                           zip(sorted(glob('unittest0*.nc')), inodes)],
+                          [False, True, False, False, False])
+        self.assertEquals(glob('.unittest0*.nc.*.tmp'), [])
+        # check if remove the staged copies when a file can't be opened.
+        with open('unittest_broken.nc', 'w') as broken:
+            broken.write('broken')
+        with self.assertRaises(Exception):
+            nc.open(['unittest00.nc', 'unittest_broken.nc'],
+                    transaction=True)
+        self.assertEquals(glob('.unittest*.tmp'), [])
+        # check if the created variables are checksummed.
+        root = nc.open('unittest_checksum.nc', transaction=True,
+                       checksum=True)[0]
+        self.assertFalse(os.path.exists('unittest_checksum.nc'))
+        nc.getdim(root, 'xc', 200)
+        var = nc.getvar(root, 'checked', 'f4', ('xc',))
+        var[:] = np.arange(200)
+        self.assertTrue(var.variables[0].filters()['fletcher32'])
+        nc.close(root)
+        mask = os.umask(0)
+        os.umask(mask)
+        mode = stat.S_IMODE(os.stat('unittest_checksum.nc').st_mode)
+        self.assertEquals(mode, 0o666 & ~mask)
+        with nc.loader('unittest_checksum.nc') as root:
+            self.assertTrue((nc.getvar(root, 'checked')[:] ==
+                             np.arange(200)).all())
+        # check if remove the copies of a process dead before the commit.
+        code = ('import os; from netcdf import netcdf as nc; '
+                'root = nc.open("unittest0*.nc", transaction=True)[0]; '
+                'nc.getvar(root, "data")[:] = 7.; nc.sync(root); '
+                'os._exit(1)')
+        subprocess.call([sys.executable, '-c', code])
+        self.assertEquals(len(glob('.unittest0*.nc.*.tmp')), 5)
+        nc.rollback(nc.open('unittest0*.nc', transaction=True)[0])
+        self.assertEquals(glob('.unittest0*.nc.*.tmp'), [])
+        with nc.loader('unittest0*.nc') as root:
+            self.assertEquals(list(nc.getvar(root, 'data')[:, 0, 0]),
+                              [2, 3, 2, 2, 2])
+        # check if complete a commit interrupted after the first file.
+        code = ('import os; from netcdf import netcdf as nc; '
+                'root = nc.open("unittest0*.nc", transaction=True)[0]; '
+                'nc.getvar(root, "data")[:] = 7.; rename = os.rename; '
+                'renames = []; os.rename = lambda *args: (rename(*args), '
+                'renames.append(args), len(renames) > 1 and os._exit(1)); '
+                'nc.close(root)')
+        subprocess.call([sys.executable, '-c', code])
+        self.assertEquals(len(glob('.unittest0*.nc.*.tmp')), 4)
+        self.assertEquals(len(glob('.netcdf.*.journal')), 1)
+        nc.rollback(nc.open('unittest0*.nc', transaction=True)[0])
+        self.assertEquals(glob('.unittest0*.nc.*.tmp'), [])
+        self.assertEquals(glob('.netcdf.*.journal'), [])
+        with nc.loader('unittest0*.nc') as root:
+            self.assertTrue((nc.getvar(root, 'data')[:] == 7.).all())
+
     def test_character_variables_in_single_file(self):
         # check if get and set the numpy string matrix in single files.
         root = nc.open('unittest00.nc')[0]
@@ -368,6 +675,100 @@ class TestNetcdf(unittest.TestCase):
         diff = var_distributed[:] - var_distributed_int[:]
         self.assertTrue((diff < 1).all())
 
+    def test_subset_bounding_box(self):
+        lat, lon = np.mgrid[-50:50, -100:100]
+        for ref in self.refs:
+            ref.variables['lat'][:] = lat
+            ref.variables['lon'][:] = lon
+            ref.sync()
+        root = nc.open('unittest0*.nc')[0]
+        # check if the subset only contains the window of the bounding box.
+        sub = nc.subset(root, (-10, 10, 0, 19))
+        self.assertIn((-10, 10, 0, 19), root.windows)
+        data = nc.getvar(sub, 'data')
+        self.assertEquals(data.shape, (5, 21, 20))
+        self.assertEquals(nc.getvar(sub, 'lat')[0, 0, 0], -10)
+        self.assertEquals(nc.getvar(sub, 'lon')[0, 0, -1], 19)
+        # check if the changes are only written inside the window.
+        data[:] = np.zeros(data.shape) + 2.
+        full = nc.getvar(root, 'data')
+        self.assertTrue((full[:, 40:61, 100:120] == 2.).all())
+        self.assertEquals(full[:].sum(), 5 * (100 * 200 + 21 * 20))
+        with self.assertRaisesRegexp(Exception, u'The bounding box is '
+                                     'outside of the grid.'):
+            nc.subset(root, (60, 70, 0, 10))
+        nc.close(root)
+
+    def test_overlay_over_readonly_file(self):
+        # set the file to be readonly.
+        filename = 'ro_unittest.nc'
+        if os.path.isfile(filename):
+            os.chmod(filename, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        # check if the changes are kept in memory and merged on each read.
+        root = nc.open(filename, overlay=True)[0]
+        self.assertTrue(root.read_only)
+        var = nc.getvar(root, 'auditTrail')
+        self.auditTrail[:].data[0:6] = 'CHANGE'
+        var[0, 0:6] = np.array(list('CHANGE'))
+        self.assertEquals(var, self.auditTrail)
+        self.assertEquals(list(root.delta['auditTrail'].keys()), [0])
+        data = nc.getvar(root, 'data')
+        data[:] = data[:] + 1
+        self.assertTrue((data[:] == 2.).all())
+        nc.close(root)
+        # check if the file was not modified.
+        root = nc.open(filename)[0]
+        self.assertTrue((nc.getvar(root, 'data')[:] == 1.).all())
+        nc.close(root)
+
+    def test_export_between_layouts(self):
+        for filename in glob('unittest0*.nc'):
+            ref = Dataset(filename, mode='a')
+            ref.setncattr('title', 'unittest')
+            ref.close()
+        root = nc.open('unittest0*.nc')[0]
+        data = nc.getvar(root, 'data')
+        data[:] = np.vstack([np.zeros((1, 100, 200)) + i for i in range(5)])
+        # check if join the files by group.
+        group = lambda filename, step: 'odd' if '1' in filename else 'even'
+        progress = []
+        files = nc.export(root, 'unittest_%s.nc', group_by=group,
+                          variables=['time', 'lat', 'data'],
+                          storage={'complevel': 9}, workers=2,
+                          progress=lambda *args: progress.append(args))
+        self.assertEquals(files, ['unittest_even.nc', 'unittest_odd.nc'])
+        self.assertEquals(sorted(progress), [(1, 2), (2, 2)])
+        nc.close(root)
+        root = nc.open('unittest_even.nc')[0]
+        self.assertEquals(sorted(root.roots[0].variables.keys()),
+                          ['data', 'lat', 'time'])
+        self.assertEquals(len(nc.getdim(root, 'time')[0]), 4)
+        data = nc.getvar(root, 'data')
+        self.assertEquals(data.shape, (1, 4, 100, 200))
+        self.assertEquals(list(data[0, :, 0, 0]), [0, 2, 3, 4])
+        self.assertEquals(data.variables[0].filters()['complevel'], 9)
+        self.assertEquals(root.roots[0].getncattr('title'), 'unittest')
+        # check if split a file into one file by time step.
+        group = lambda filename, step: str(step)
+        files = nc.export(root, 'unittest_step_%s.nc', group_by=group)
+        self.assertEquals(len(files), 4)
+        nc.close(root)
+        root = nc.open('unittest_step_*.nc')[0]
+        data = nc.getvar(root, 'data')
+        self.assertEquals(data.shape, (4, 100, 200))
+        self.assertEquals(list(data[:, 0, 0]), [0, 2, 3, 4])
+        nc.close(root)
+        # check if refuse to join files without an unlimited dimension.
+        for i in range(2):
+            ref = Dataset('unittest_fixed_%i.nc' % i, mode='w')
+            ref.createDimension('xc', 200)
+            ref.createVariable('data', 'f4', ('xc',))[:] = i
+            ref.close()
+        root = nc.open('unittest_fixed_*.nc')[0]
+        with self.assertRaisesRegexp(Exception, u'can not be joined'):
+            nc.export(root, 'unittest_fixed.nc')
+        nc.close(root)
+
 
 if __name__ == '__main__':
         unittest.main()
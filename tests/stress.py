@@ -0,0 +1,191 @@
+"""
+Stress the library with concurrent reader and writer processes over a
+synthetic package, with the same layout used by the tests (time, yc, xc,
+data, lat and lon), and report the throughput, latency percentiles and the
+errors of each operation.
+
+Usage:
+    python tests/stress.py --files 10 --readers 8 --writers 2 --duration 30
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from netcdf import netcdf as nc
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+def create_file(filename, shape, value):
+    root, _ = nc.open(filename)
+    nc.getdim(root, 'time')
+    nc.getdim(root, 'yc', shape[0])
+    nc.getdim(root, 'xc', shape[1])
+    nc.getvar(root, 'time', 'i4', ('time',), fill_value=0)[0] = value
+    lat, lon = np.mgrid[-shape[0] // 2:shape[0] // 2, 0:shape[1]]
+    nc.getvar(root, 'lat', 'f4', ('yc', 'xc'), fill_value=0.)[:] = lat
+    nc.getvar(root, 'lon', 'f4', ('yc', 'xc'), fill_value=0.)[:] = lon
+    data = nc.getvar(root, 'data', 'f4', ('time', 'yc', 'xc'),
+                     fill_value=0.)
+    data[:] = np.zeros((1,) + shape) + value
+    nc.close(root)
+
+
+class Worker(object):
+
+    def __init__(self, role, number, options, results):
+        super(Worker, self).__init__()
+        self.role = role
+        self.number = number
+        self.options = options
+        self.results = results
+        self.latencies = {}
+        self.errors = {}
+
+    def measure(self, operation, function, *args):
+        begin = time.time()
+        try:
+            return function(*args)
+        except Exception as error:
+            # group the errors without the filenames of the messages.
+            message = str(error).split("'")[0].strip()
+            key = (operation, error.__class__.__name__, message)
+            self.errors[key] = self.errors.get(key, 0) + 1
+            raise
+        finally:
+            (self.latencies.setdefault(operation, [])
+             .append(time.time() - begin))
+
+    def read(self):
+        root, _ = self.measure('open', nc.open, self.options.pattern)
+        try:
+            data = self.measure('getvar', nc.getvar, root, 'data')
+            index = np.random.randint(len(root.files))
+            self.measure('read', data.__getitem__, index)
+        finally:
+            self.measure('close', nc.close, root)
+
+    def write(self, step):
+        filename = os.path.join(self.options.directory, 'stress_%02i_%06i.nc'
+                                % (self.number, step))
+        self.measure('append', create_file, filename, self.options.shape,
+                     step)
+        root, _ = self.measure('open', nc.open, filename)
+        try:
+            data = self.measure('getvar', nc.getvar, root, 'data')
+            self.measure('write', data.__setitem__, slice(None),
+                         np.zeros(data.shape) + step + 1)
+            self.measure('sync', nc.sync, root)
+        finally:
+            self.measure('close', nc.close, root)
+
+    def __call__(self):
+        np.random.seed(os.getpid())
+        deadline = time.time() + self.options.duration
+        step = 0
+        while time.time() < deadline:
+            try:
+                if self.role == 'writer':
+                    self.write(step)
+                else:
+                    self.read()
+            except Exception:
+                pass
+            step += 1
+        self.results.put((self.role, self.number, self.latencies,
+                          self.errors))
+
+
+def collect(results, workers, processes, duration):
+    # wait the results with a deadline, counting the dead or hung workers
+    # as errors.
+    deadline = time.time() + duration + max(duration, 30.)
+    collected = {}
+    while len(collected) < len(processes) and time.time() < deadline:
+        try:
+            role, number, latencies, errors = results.get(timeout=1.)
+            collected[(role, number)] = (role, latencies, errors)
+        except Empty:
+            if not any(p.is_alive() for p in processes) and results.empty():
+                break
+    for worker, process in zip(workers, processes):
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        if (worker.role, worker.number) not in collected:
+            key = ('worker', 'DeadWorker', 'exit code %s' % process.exitcode)
+            collected[(worker.role, worker.number)] = (worker.role, {},
+                                                       {key: 1})
+    return list(collected.values())
+
+
+def report(results, duration):
+    latencies, errors = {}, {}
+    for role, measures, failures in results:
+        for operation, values in measures.items():
+            latencies.setdefault((role, operation), []).extend(values)
+        for (operation, kind, message), count in failures.items():
+            key = (role, operation, kind, message)
+            errors[key] = errors.get(key, 0) + count
+    lines = ['%-8s %-8s %8s %9s %9s %9s %9s %9s' % (
+        'role', 'op', 'count', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms',
+        'max ms')]
+    for (role, operation), values in sorted(latencies.items()):
+        values = np.array(values) * 1000.
+        lines.append('%-8s %-8s %8i %9.2f %9.2f %9.2f %9.2f %9.2f' % (
+            (role, operation, len(values), len(values) / duration) +
+            tuple(np.percentile(values, [50, 90, 99])) + (values.max(),)))
+    lines.append('')
+    lines.append('errors: %i' % sum(errors.values()))
+    for (role, operation, kind, message), count in sorted(errors.items()):
+        lines.append('%-8s %-8s %8i %s: %s' % (role, operation, count, kind,
+                                              message))
+    return os.linesep.join(lines) + os.linesep
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=10,
+                        help='files of the initial package')
+    parser.add_argument('--readers', type=int, default=4,
+                        help='processes opening and reading the package')
+    parser.add_argument('--writers', type=int, default=1,
+                        help='processes appending files to the package')
+    parser.add_argument('--duration', type=float, default=10.,
+                        help='seconds of the test')
+    parser.add_argument('--shape', type=int, nargs=2, default=[100, 200],
+                        help='the yc and xc sizes of each file')
+    parser.add_argument('--directory', default='',
+                        help='directory of the package (default temporary)')
+    options = parser.parse_args(arguments)
+    options.shape = tuple(options.shape)
+    temporary = not options.directory
+    options.directory = options.directory or tempfile.mkdtemp()
+    options.pattern = os.path.join(options.directory, 'stress_*.nc')
+    try:
+        for step in range(options.files):
+            create_file(os.path.join(options.directory,
+                                     'stress_xx_%06i.nc' % step),
+                        options.shape, step)
+        results = multiprocessing.Queue()
+        workers = ([Worker('reader', i, options, results)
+                    for i in range(options.readers)] +
+                   [Worker('writer', i, options, results)
+                    for i in range(options.writers)])
+        processes = [multiprocessing.Process(target=w) for w in workers]
+        list(map(lambda p: p.start(), processes))
+        collected = collect(results, workers, processes, options.duration)
+        sys.stdout.write(report(collected, options.duration))
+    finally:
+        if temporary:
+            shutil.rmtree(options.directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])